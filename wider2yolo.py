@@ -1,62 +1,124 @@
 import os
-import xml.etree.ElementTree as ET
+import re
+import functools
+import struct
+import tempfile
 from PIL import Image
 import logging
+from concurrent.futures import ProcessPoolExecutor
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Characters that must be escaped in XML text content
+_XML_ESCAPES = (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('"', '&quot;'))
 
-def convert_to_yolo(bbox, img_width, img_height):
-    xmin, ymin, width, height = bbox
-    x_center = (xmin + width / 2) / img_width
-    y_center = (ymin + height / 2) / img_height
-    width_norm = width / img_width
-    height_norm = height / img_height
-    return f"0 {x_center} {y_center} {width_norm} {height_norm}"
+# One YOLO label line: class 0 (face) followed by the normalized box center and size
+YOLO_LINE_FORMAT = '0 %.6f %.6f %.6f %.6f\n'
 
-def create_voc_xml(filename, width, height, bounding_boxes, output_dir):
-    annotation = ET.Element("annotation")
+# Fixed parts of the VOC XML document; only the % fields differ between images
+VOC_PREFIX = (
+    '<annotation><folder>%s</folder><filename>%s</filename>'
+    '<source><database>WIDER Face</database></source>'
+    '<size><width>%d</width><height>%d</height><depth>3</depth></size>'
+    '<segmented>0</segmented>'
+)
+VOC_OBJECT = (
+    '<object><name>face</name><pose>Unspecified</pose><truncated>0</truncated><difficult>0</difficult>'
+    '<bndbox><xmin>%d</xmin><ymin>%d</ymin><xmax>%d</xmax><ymax>%d</ymax></bndbox></object>'
+)
+VOC_SUFFIX = '</annotation>'
 
-    # Folder and Filename
-    ET.SubElement(annotation, "folder").text = os.path.basename(output_dir)
-    ET.SubElement(annotation, "filename").text = os.path.basename(filename)
+# JPEG start-of-frame markers (all except DHT 0xC4, JPG 0xC8 and DAC 0xCC)
+_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
 
-    # Source
-    source = ET.SubElement(annotation, "source")
-    ET.SubElement(source, "database").text = "WIDER Face"
+# Image line of the annotation file
+_IMAGE_LINE_RE = re.compile(rb'\s*(.+?\.jpe?g)\s*$', re.IGNORECASE)
 
-    # Size
-    size = ET.SubElement(annotation, "size")
-    ET.SubElement(size, "width").text = str(width)
-    ET.SubElement(size, "height").text = str(height)
-    ET.SubElement(size, "depth").text = "3"
+# Read buffer for the annotation file, large enough to need only a few read() calls
+_ANNOTATION_BUFFER_SIZE = 1 << 20
 
-    # Segmented
-    ET.SubElement(annotation, "segmented").text = "0"
+# Number of images parsed before they are handed to the worker processes; bounds the memory held by pending tasks
+_TASK_BATCH_SIZE = 4096
+
+# Output directories already created during this run
+_created_dirs = set()
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+def ensure_dir(path):
+    if path not in _created_dirs:
+        os.makedirs(path, exist_ok=True)
+        _created_dirs.add(path)
+
+def _write_atomic(path, content, mode='w'):
+    # Write to a temporary file first so an interrupted run never leaves a truncated output
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, mode) as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def _filesystem_time(directory):
+    # Current time as recorded by the filesystem, which may lag behind time.time()
+    fd, marker_path = tempfile.mkstemp(dir=directory)
+    try:
+        os.close(fd)
+        return os.path.getmtime(marker_path)
+    finally:
+        os.remove(marker_path)
+
+def _is_up_to_date(path, source_mtime, run_start):
+    # An output is up to date if it was written after the annotation file was last changed,
+    # but before this run started; files written earlier in this run (duplicate entries,
+    # VOC files sharing a basename) must not block later entries from overwriting them
+    if source_mtime is None:
+        return False
+    try:
+        return source_mtime < os.path.getmtime(path) < run_start
+    except OSError:
+        return False
+
+def convert_to_yolo(bounding_boxes, img_width, img_height):
+    # Convert all boxes of an image at once and return the complete YOLO file content
+    return ''.join([
+        YOLO_LINE_FORMAT % ((xmin + width / 2) / img_width, (ymin + height / 2) / img_height, width / img_width, height / img_height)
+        for xmin, ymin, width, height in bounding_boxes
+    ])
+
+def _xml_escape(text):
+    for char, entity in _XML_ESCAPES:
+        text = text.replace(char, entity)
+    return text
+
+def create_voc_xml(filename, width, height, bounding_boxes, xml_output_path):
+    # Folder and Filename
+    folder = _xml_escape(os.path.basename(os.path.dirname(xml_output_path)))
+    name = _xml_escape(os.path.basename(filename))
 
     # Objects (Bounding Boxes)
+    valid_boxes = []
     for bbox in bounding_boxes:
         if len(bbox) != 4:
             logging.warning(f"Invalid bounding box: {bbox}")
             continue
+        valid_boxes.append(bbox)
 
-        obj = ET.SubElement(annotation, "object")
-        ET.SubElement(obj, "name").text = "face"
-        ET.SubElement(obj, "pose").text = "Unspecified"
-        ET.SubElement(obj, "truncated").text = "0"
-        ET.SubElement(obj, "difficult").text = "0"
-
-        bndbox = ET.SubElement(obj, "bndbox")
-        ET.SubElement(bndbox, "xmin").text = str(bbox[0])
-        ET.SubElement(bndbox, "ymin").text = str(bbox[1])
-        ET.SubElement(bndbox, "xmax").text = str(bbox[0] + bbox[2])
-        ET.SubElement(bndbox, "ymax").text = str(bbox[1] + bbox[3])
+    # The schema is fixed, so the document is formatted from templates instead of an element tree
+    xml = ''.join([
+        VOC_PREFIX % (folder, name, width, height),
+        *[VOC_OBJECT % (xmin, ymin, xmin + box_width, ymin + box_height)
+          for xmin, ymin, box_width, box_height in valid_boxes],
+        VOC_SUFFIX,
+    ])
 
     # Save the XML file
-    xml_output_path = os.path.join(output_dir, os.path.splitext(os.path.basename(filename))[0] + '.xml')
-    os.makedirs(os.path.dirname(xml_output_path), exist_ok=True)  # Create directories if they don't exist
-    tree = ET.ElementTree(annotation)
-    tree.write(xml_output_path)
+    ensure_dir(os.path.dirname(xml_output_path))  # Create directories if they don't exist
+    _write_atomic(xml_output_path, xml.encode('utf-8'), 'wb')
     logging.info(f"XML saved to {xml_output_path}")
 
 def get_image_size(image_path):
@@ -68,117 +130,187 @@ def get_image_size(image_path):
         logging.error(f"Error opening image {image_path}: {e}")
         return None, None
 
-def filter_annotations(file_path, image_dir, output_annotations_file):
-    logging.info("Checking and filtering annotation file for existing images...")
-    with open(file_path, 'r') as file:
-        lines = file.readlines()
-
-    index = 0
-    total_lines = len(lines)
-    filtered_lines = []
-    missing_images = []
+def _jpeg_size(image_path):
+    # Read width/height from the JPEG start-of-frame header without decoding the image
+    try:
+        with open(image_path, 'rb') as file:
+            if file.read(2) != b'\xff\xd8':
+                raise ValueError("not a JPEG file")
+            while True:
+                byte = file.read(1)
+                while byte and byte != b'\xff':
+                    byte = file.read(1)
+                while byte == b'\xff':  # Skip fill bytes
+                    byte = file.read(1)
+                if not byte:
+                    raise ValueError("no start-of-frame marker found")
+
+                marker = byte[0]
+                if marker in _SOF_MARKERS:
+                    height, width = struct.unpack('>HH', file.read(7)[3:7])
+                    logging.debug(f"Image size for {image_path}: {width}x{height}")
+                    return width, height
+                if marker in (0xD9, 0xDA):
+                    raise ValueError("no start-of-frame marker before image data")
+                if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+                    continue  # Standalone markers have no length field
+
+                segment_length = struct.unpack('>H', file.read(2))[0]
+                file.seek(segment_length - 2, os.SEEK_CUR)
+    except (OSError, ValueError, struct.error) as e:
+        logging.debug(f"Could not read JPEG header of {image_path}, falling back to PIL: {e}")
+        return get_image_size(image_path)
+
+def _list_dir(directory):
+    # Names of all entries in a directory, or an empty set if it does not exist
+    try:
+        with os.scandir(directory) as entries:
+            return {entry.name for entry in entries}
+    except OSError:
+        return set()
+
+def _process_one(task, yolo_prefix, voc_prefix, image_prefix, source_mtime=None, yolo_run_start=None, voc_run_start=None):
+    current_image, bounding_boxes = task
+
+    # Annotation paths use '/'; the prefixes are normalized once in run(), so plain concatenation suffices
+    sep = os.sep
+    rel_path = current_image if sep == '/' else current_image.replace('/', sep)
+
+    # Skip outputs that are newer than the annotation file, e.g. when re-running after a failure
+    # VOC files are written flat into the VOC directory, named after the image file only
+    yolo_output_path = yolo_prefix + os.path.splitext(rel_path)[0] + '.txt'
+    voc_output_path = voc_prefix + os.path.splitext(os.path.basename(rel_path))[0] + '.xml'
+    yolo_current = _is_up_to_date(yolo_output_path, source_mtime, yolo_run_start)
+    voc_current = _is_up_to_date(voc_output_path, source_mtime, voc_run_start)
+    if yolo_current and voc_current:
+        logging.debug(f"Outputs for {current_image} are up to date, skipping.")
+        return False, False, True
+
+    # Process the current image with bounding boxes
+    image_path = image_prefix + rel_path
+    logging.info(f"Trying to open image: {image_path}")
+    img_width, img_height = _jpeg_size(image_path)
+    if img_width is None or img_height is None:
+        logging.warning(f"Skipping image due to missing size information: {current_image}")
+        return False, False, False
+
+    # Save YOLO file
+    yolo_saved = False
+    if not yolo_current:
+        try:
+            ensure_dir(os.path.dirname(yolo_output_path))  # Create directories if they don't exist
+            _write_atomic(yolo_output_path, convert_to_yolo(bounding_boxes, img_width, img_height))
+            yolo_saved = True
+            logging.info(f"YOLO saved to {yolo_output_path}")
+        except Exception as e:
+            logging.error(f"Error saving YOLO file: {yolo_output_path}, Error: {e}")
+
+    # Save VOC XML file
+    voc_saved = False
+    if not voc_current:
+        try:
+            create_voc_xml(rel_path, img_width, img_height, bounding_boxes, voc_output_path)
+            voc_saved = True
+        except Exception as e:
+            logging.error(f"Error creating VOC XML file for {current_image}: {e}")
+
+    return yolo_saved, voc_saved, False
+
+def _add_results(totals, results):
+    # Wait for a batch and add its (yolo_saved, voc_saved, skipped) flags to the running totals
+    for yolo_saved, voc_saved, skipped in results:
+        totals[0] += yolo_saved
+        totals[1] += voc_saved
+        totals[2] += skipped
+
+def run(annotations_file, image_dir, output_yolo_dir, output_voc_dir, force=False):
+    logging.info("Starting annotation processing.")
+    # Unless forced, outputs written after the last change of the annotation file and before this run are kept
+    source_mtime = None if force else os.path.getmtime(annotations_file)
+    # Directories may have been removed since an earlier run in this process
+    _created_dirs.clear()
+    os.makedirs(output_yolo_dir, exist_ok=True)
+    os.makedirs(output_voc_dir, exist_ok=True)
+    # The output roots may be on different filesystems, so each gets its own start time
+    yolo_run_start = None if force else _filesystem_time(output_yolo_dir)
+    voc_run_start = None if force else _filesystem_time(output_voc_dir)
+    # Normalize the base directories once instead of joining and normalizing every image path
+    image_prefix = os.path.normpath(image_dir) + os.sep
+    yolo_prefix = os.path.normpath(output_yolo_dir) + os.sep
+    voc_prefix = os.path.normpath(output_voc_dir) + os.sep
+    batch = []
+    batch_outputs = set()  # Output keys of the images in the current batch
+    pending_results = []
     processed_images = 0
+    missing_images = []  # Only the first 10, for the report
+    missing_count = 0
+    dir_listings = {}  # Image subdirectory -> names of the files in it
+    totals = [0, 0, 0]  # YOLO files created, VOC XML files created, images skipped
+
+    # Images are independent of each other, so their output files are written in parallel
+    worker = functools.partial(_process_one, yolo_prefix=yolo_prefix, voc_prefix=voc_prefix,
+                               image_prefix=image_prefix, source_mtime=source_mtime,
+                               yolo_run_start=yolo_run_start, voc_run_start=voc_run_start)
+
+    # Single pass: skip missing images and collect the bounding boxes of existing ones.
+    # The file is only scanned forward and parsed images are dispatched in batches, so
+    # memory stays bounded by the batch size rather than the size of the annotation file.
+    # Lines are matched as raw bytes; only image names and logged lines are decoded.
+    with open(annotations_file, 'rb', buffering=_ANNOTATION_BUFFER_SIZE) as file, ProcessPoolExecutor() as executor:
+        lines = iter(file)
+        for line in lines:
+            logging.debug("Processing line: %r", line)
+            match = _IMAGE_LINE_RE.match(line)
+            if match is None:
+                logging.warning(f"Unexpected line: {line.strip().decode(errors='replace')}")
+                continue
 
-    while index < total_lines:
-        line = lines[index].strip()
-        if line.lower().endswith(('.jpg', '.jpeg')):
-            current_image = line
-            image_path = os.path.normpath(os.path.join(image_dir, current_image))
-            if os.path.exists(image_path):
-                filtered_lines.append(line + '\n')
-                index += 1
-                if index >= total_lines:
-                    logging.warning(f"No bounding boxes found for image {current_image}.")
+            current_image = os.fsdecode(match.group(1))
+            num_boxes_line = next(lines, None)
+
+            # List each image subdirectory once instead of checking every image path
+            subdir, image_name = os.path.split(current_image)
+            listing = dir_listings.get(subdir)
+            if listing is None:
+                listing = dir_listings[subdir] = _list_dir(image_prefix + subdir)
+            # On a miss, ask the filesystem, which may match names case-insensitively (Windows, macOS)
+            if image_name not in listing and not os.path.exists(image_prefix + current_image):
+                missing_count += 1
+                if len(missing_images) < 10:
+                    missing_images.append(current_image)
+                if num_boxes_line is None:
                     break
-
-                # Read the number of bounding boxes
-                num_boxes_line = lines[index].strip()
+                # Skip the bounding boxes of the missing image
                 try:
                     num_boxes = int(num_boxes_line)
-                    filtered_lines.append(num_boxes_line + '\n')
-                    index += 1
                 except ValueError:
-                    logging.warning(f"Expected number of bounding boxes after image {current_image}, but got: {num_boxes_line}")
-                    index += 1
                     continue
-
-                # Read the bounding boxes
                 for _ in range(num_boxes):
-                    if index >= total_lines:
-                        logging.warning(f"Not enough bounding box lines for image {current_image}. Expected {num_boxes}, but found fewer.")
+                    if next(lines, None) is None:
                         break
-                    bbox_line = lines[index].strip()
-                    filtered_lines.append(bbox_line + '\n')
-                    index += 1
-                processed_images += 1
-            else:
-                missing_images.append(current_image)
-                index += 1
-                if index >= total_lines:
-                    break
-                # Read the number of bounding boxes
-                try:
-                    num_boxes = int(lines[index].strip())
-                    index += 1 + num_boxes
-                except ValueError:
-                    index += 1
-        else:
-            logging.warning(f"Unexpected line: {line}")
-            index += 1
-
-    # Write the filtered annotations
-    with open(output_annotations_file, 'w') as outfile:
-        outfile.writelines(filtered_lines)
-
-    logging.info(f"Filtered annotation file created: {output_annotations_file}")
-    logging.info(f"Processed images: {processed_images}")
-    logging.info(f"Missing images: {len(missing_images)}")
-    if len(missing_images) > 0:
-        logging.warning(f"Examples of missing images:")
-        for img in missing_images[:10]:  # Show only the first 10 missing images
-            logging.warning(f"- {img}")
-        if len(missing_images) > 10:
-            logging.warning(f"... and {len(missing_images) - 10} more missing images.")
+                continue
 
-def process_annotations(file_path, output_yolo_dir, output_voc_dir, image_dir):
-    logging.info("Starting annotation processing.")
-    with open(file_path, 'r') as file:
-        lines = file.readlines()
-    logging.info(f"Number of lines in annotation file: {len(lines)}")
-
-    index = 0
-    total_lines = len(lines)
-    yolo_file_count = 0
-    voc_file_count = 0
-
-    while index < total_lines:
-        line = lines[index].strip()
-        logging.debug(f"Processing line {index + 1}: {line}")
-        if line.lower().endswith(('.jpg', '.jpeg')):
-            current_image = line
             logging.info(f"Found image: {current_image}")
-            index += 1
-            if index >= total_lines:
+            if num_boxes_line is None:
                 logging.warning(f"No bounding boxes found for image {current_image}.")
                 break
 
             # Read the number of bounding boxes
-            num_boxes_line = lines[index].strip()
+            num_boxes_line = num_boxes_line.strip()
             try:
                 num_boxes = int(num_boxes_line)
                 logging.info(f"Number of bounding boxes for {current_image}: {num_boxes}")
-                index += 1
             except ValueError:
-                logging.warning(f"Expected number of bounding boxes after image {current_image}, but got: {num_boxes_line}")
-                index += 1
+                logging.warning(f"Expected number of bounding boxes after image {current_image}, but got: {num_boxes_line.decode(errors='replace')}")
                 continue
 
             bounding_boxes = []
             for _ in range(num_boxes):
-                if index >= total_lines:
+                bbox_line = next(lines, None)
+                if bbox_line is None:
                     logging.warning(f"Not enough bounding box lines for image {current_image}. Expected {num_boxes}, but found fewer.")
                     break
-                bbox_line = lines[index].strip()
+                bbox_line = bbox_line.strip()
                 bbox_values = bbox_line.split()
                 if len(bbox_values) >= 4:
                     try:
@@ -186,61 +318,57 @@ def process_annotations(file_path, output_yolo_dir, output_voc_dir, image_dir):
                         bounding_boxes.append(bbox)
                         logging.debug(f"Found bounding box: {bbox}")
                     except ValueError:
-                        logging.warning(f"Invalid bounding box values: {bbox_line} for image {current_image}")
+                        logging.warning(f"Invalid bounding box values: {bbox_line.decode(errors='replace')} for image {current_image}")
                 else:
-                    logging.warning(f"Incomplete bounding box data: {bbox_line} for image {current_image}")
-                index += 1
-
-            # Process the current image with bounding boxes
-            normalized_image_path = os.path.normpath(current_image)
-            image_path = os.path.join(image_dir, normalized_image_path)
-            logging.info(f"Trying to open image: {image_path}")
-            img_width, img_height = get_image_size(image_path)
-            if img_width is None or img_height is None:
-                logging.warning(f"Skipping image due to missing size information: {current_image}")
-                continue
+                    logging.warning(f"Incomplete bounding box data: {bbox_line.decode(errors='replace')} for image {current_image}")
+
+            # Entries sharing an output (duplicates, or the same basename in the flat VOC folder)
+            # must not be written concurrently; starting a new batch keeps them in file order
+            image_stem = os.path.normcase(os.path.splitext(current_image)[0])
+            output_keys = (('yolo', image_stem), ('voc', os.path.basename(image_stem)))
+            collides = not batch_outputs.isdisjoint(output_keys)
+            if collides:
+                logging.warning(f"Outputs of {current_image} collide with an earlier entry; the earlier outputs will be overwritten.")
+            if collides or len(batch) >= _TASK_BATCH_SIZE:
+                # Keep one batch in flight while the next one is parsed; a batch is only
+                # submitted after the previous one has finished
+                _add_results(totals, pending_results)
+                pending_results = executor.map(worker, batch, chunksize=64)
+                batch = []
+                batch_outputs.clear()
+
+            batch.append((current_image, bounding_boxes))
+            batch_outputs.update(output_keys)
+            processed_images += 1
+
+        _add_results(totals, pending_results)
+        _add_results(totals, executor.map(worker, batch, chunksize=64))
+    yolo_file_count, voc_file_count, skipped_count = totals
 
-            # Save YOLO file
-            yolo_output_path = os.path.join(output_yolo_dir, os.path.splitext(normalized_image_path)[0] + '.txt')
-            try:
-                os.makedirs(os.path.dirname(yolo_output_path), exist_ok=True)  # Create directories if they don't exist
-                with open(yolo_output_path, 'w') as yolo_file:
-                    for bbox in bounding_boxes:
-                        yolo_line = convert_to_yolo(bbox, img_width, img_height)
-                        if yolo_line:
-                            yolo_file.write(yolo_line + '\n')
-                yolo_file_count += 1
-                logging.info(f"YOLO saved to {yolo_output_path}")
-            except Exception as e:
-                logging.error(f"Error saving YOLO file: {yolo_output_path}, Error: {e}")
-
-            # Save VOC XML file
-            try:
-                create_voc_xml(normalized_image_path, img_width, img_height, bounding_boxes, output_voc_dir)
-                voc_file_count += 1
-            except Exception as e:
-                logging.error(f"Error creating VOC XML file for {current_image}: {e}")
-
-        else:
-            logging.warning(f"Unexpected line: {line}")
-            index += 1
+    logging.info(f"Processed images: {processed_images}")
+    logging.info(f"Missing images: {missing_count}")
+    if missing_count > 0:
+        logging.warning(f"Examples of missing images:")
+        for img in missing_images:
+            logging.warning(f"- {img}")
+        if missing_count > 10:
+            logging.warning(f"... and {missing_count - 10} more missing images.")
 
     # Summary of generated files
     logging.info(f"YOLO files created: {yolo_file_count}, VOC XML files created: {voc_file_count}")
-
-# Example directories and parameters
-annotations_file = r'YOUR PATH HERE'  # Use the validation annotation file
-output_yolo_dir = r'output/yolo'
-output_voc_dir = r'output/voc'
-image_dir = r'YOUR PATH HERE'  # Path to validation images
-
-# Create directories if they don't exist
-os.makedirs(output_yolo_dir, exist_ok=True)
-os.makedirs(output_voc_dir, exist_ok=True)
-
-# Optional: Create a filtered annotation file
-filtered_annotations_file = r'YOUR PATH HERE'
-filter_annotations(annotations_file, image_dir, filtered_annotations_file)
-
-# Process annotations with the filtered annotation file
-process_annotations(filtered_annotations_file, output_yolo_dir, output_voc_dir, image_dir)
+    logging.info(f"Images skipped because their outputs are up to date: {skipped_count}")
+
+if __name__ == '__main__':
+    # Example directories and parameters
+    annotations_file = r'YOUR PATH HERE'  # Use the validation annotation file
+    output_yolo_dir = r'output/yolo'
+    output_voc_dir = r'output/voc'
+    image_dir = r'YOUR PATH HERE'  # Path to validation images
+    force = False  # Rewrite outputs even if they are newer than the annotation file
+
+    # Create directories if they don't exist
+    os.makedirs(output_yolo_dir, exist_ok=True)
+    os.makedirs(output_voc_dir, exist_ok=True)
+
+    # Convert the annotations of all existing images
+    run(annotations_file, image_dir, output_yolo_dir, output_voc_dir, force=force)